@@ -1,13 +1,57 @@
 #!/usr/bin/env python
 
-import bencode
+from cStringIO import StringIO
+
+# bdecode_prefix decodes the bencoded value at the start of a string,
+# which may be followed by other data, and returns the value together
+# with the number of bytes it took up.
+try:
+    # better-bencode comes with a C implementation of the codec, which
+    # is a lot faster than the pure Python one in bencode.
+    from better_bencode import dumps as bencode, loads as bdecode
+    from better_bencode import BencodeValueError as BTFailure
+    from better_bencode import load as _bload
+
+    def bdecode_prefix(x):
+        f = StringIO(x)
+        r = _bload(f)
+        return r, f.tell()
+except ImportError:
+    from bencode import bencode, bdecode, BTFailure
+    from bencode import decode_func as _decode_func
+
+    def bdecode_prefix(x):
+        try:
+            return _decode_func[x[0]](x, 0)
+        except (IndexError, KeyError, ValueError):
+            raise BTFailure('not a valid bencoded string')
+
+def _bdecode_dict(x, trailing_data=False):
+    # decodes a bencoded dictionary received from a peer and returns it
+    # together with its encoded length. better-bencode raises TypeError
+    # for some invalid input (e.g. unhashable keys) and decodes a stray
+    # 'e' to StopIteration, so all such failures, and any value that is
+    # not a dictionary, are reported as BTFailure. unless trailing_data
+    # is true, nothing may follow the dictionary.
+    try:
+        r, l = bdecode_prefix(x)
+    except (BTFailure, TypeError):
+        raise BTFailure('not a valid bencoded string')
+    if not isinstance(r, dict):
+        raise BTFailure('not a bencoded dictionary')
+    if not trailing_data and l != len(x):
+        raise BTFailure('invalid bencoded value (data after valid prefix)')
+    return r, l
 
 import argparse
 import hashlib
 import logging
+import mmap
+import os
+import stat
 import sys
 import struct
-from socket import ntohl, ntohs
+from binascii import hexlify
 from collections import defaultdict
 
 class BitTorrentParserError(Exception):
@@ -23,26 +67,56 @@ class InvalidBitTorrentStreamError(BitTorrentParserError):
 
 EXT_ALLOWED_FAST = 1
 
+# pstrlen followed by pstr, the start of every BitTorrent handshake.
+_BT_HANDSHAKE_PREFIX = '\x13BitTorrent protocol'
+
+# precompiled formats for the fixed-size parts of the messages. all of
+# them are in network byte order.
+_U32 = struct.Struct('>I')
+_U16 = struct.Struct('>H')
+_HANDSHAKE_IDS = struct.Struct('>8s20s20s') # reserved, infohash, peerid
+_TRIPLE = struct.Struct('>III')
+_PAIR = struct.Struct('>II')
+
+# the message length is read for every message.
+_unpack_u32 = _U32.unpack_from
+
 message_parsers = {}
 extended_message_parsers = {}
 
 # maps extended message numbers to their names
 extended_message_associtions = {}
 
+# each byte in the 'added.f' and 'added6.f' fields of a ut_pex message
+# holds the flags of one peer: 0x01 means the peer prefers encryption
+# and 0x02 means it is a seeder. these are all the byte values with the
+# respective flag set.
+_PEX_PREFERS_ENCRYPTION = ''.join(chr(i) for i in range(256) if i & 0x01)
+_PEX_SEEDER = ''.join(chr(i) for i in range(256) if i & 0x02)
+
+def _count_pex_flags(flags):
+    # deleting the bytes with a flag set and comparing the lengths
+    # counts them in a single C loop per flag.
+    n = len(flags)
+    prefer_encryption = n - len(flags.translate(None, _PEX_PREFERS_ENCRYPTION))
+    seeders = n - len(flags.translate(None, _PEX_SEEDER))
+    return prefer_encryption, seeders
+
+def _as_bytes(b):
+    # on Python 2, bytes() of a memoryview returns its repr, not its
+    # contents.
+    return b.tobytes() if isinstance(b, memoryview) else b
+
 def register_message(n):
     def decorator(f):
-        def wrapper(*args, **kwargs):
-            f(*args, **kwargs)
         message_parsers[n] = f
-        return wrapper
+        return f
     return decorator
 
 def register_extended_message(n):
     def decorator(f):
-        def wrapper(*args, **kwargs):
-            f(*args, **kwargs)
         extended_message_parsers[n] = f
-        return wrapper
+        return f
     return decorator
 
 class BitTorrentParser(object):
@@ -51,132 +125,193 @@ class BitTorrentParser(object):
         self.current_infohash = ''
         self.current_peerid = ''
 
+        # the info dictionary for current_infohash, or None if it has
+        # not been added with add_info.
+        self.current_info = None
+
         self.logger = logging.getLogger('utptrace')
         self.logger.setLevel(logging.DEBUG)
         handler = logging.StreamHandler(sys.stdout)
         self.logger.addHandler(handler)
 
     def add_info(self, info):
-        self.infos[hashlib.sha1(bencode.bencode(info)).digest()] = info
+        self.infos[hashlib.sha1(bencode(info)).digest()] = info
 
     def parse_stream(self, stream):
         if len(stream) < 68:
             raise UnexpectedEndOfStreamError(
                 'The stream is less than 68 bytes long.')
 
-        pstrlen, pstr, reserved, infohash, peerid = struct.unpack('!B19s8s20s20s', stream[:68])
-        self.current_infohash = infohash
-        self.current_peerid = peerid
-
-        if pstrlen != 19 or pstr != 'BitTorrent protocol':
+        if stream[:20] != _BT_HANDSHAKE_PREFIX:
             msg = 'Stream does not contain BitTorrent data.'
             self.logger.error(msg)
             raise InvalidBitTorrentStreamError(msg)
 
-        self.logger.info('pstr: {}'.format(pstr))
-        self.logger.info('reserved: {}'.format(reserved.encode('hex')))
-        self.logger.info('infohash: {}'.format(infohash.encode('hex')))
-        self.logger.info('peerid: {}'.format(peerid.encode('hex')))
+        reserved, infohash, peerid = _HANDSHAKE_IDS.unpack_from(stream, 20)
+        self.current_infohash = infohash
+        self.current_peerid = peerid
+        self.current_info = self.infos.get(infohash)
+
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('pstr: %s', _BT_HANDSHAKE_PREFIX[1:])
+            self.logger.info('reserved: %s', hexlify(reserved))
+            self.logger.info('infohash: %s', hexlify(infohash))
+            self.logger.info('peerid: %s', hexlify(peerid))
+
+        # slicing a memoryview does not copy the underlying data, so the
+        # message parsers only pay for the parts they actually keep.
+        try:
+            stream = memoryview(stream)
+        except TypeError:
+            # on Python 2, mmap objects only support the old buffer
+            # interface. slicing them already returns just the bytes
+            # asked for, so they can be used as they are.
+            pass
+
+        # bound once here, since this loop runs for every message.
+        parse_message = self.parse_message
+        stream_length = len(stream)
 
         n = 68
-        while n < len(stream):
-            n = self.parse_message(stream, n)
+        while n < stream_length:
+            n = parse_message(stream, n)
 
     def parse_message(self, stream, n):
-        if n + 4 >= len(stream):
+        stream_length = len(stream)
+        if n + 4 >= stream_length:
             raise UnexpectedEndOfStreamError()
 
-        length = ntohl(struct.unpack('I', stream[n:n + 4])[0])
+        (length,) = _unpack_u32(stream, n)
         if length == 0:
             return n + 4
 
         id = ord(stream[n + 4])
 
-        try:
+        # this is only advisory (btparser_log_analyzer looks for it), so
+        # it is compiled out when running with -O.
+        if __debug__:
             if length > 16393:
                 self.logger.warning('Message length is over 16393. Possibly corrupt.')
-            if n + 4 + length > len(stream):
-                raise UnexpectedEndOfStreamError()
+        if n + 4 + length > stream_length:
+            raise UnexpectedEndOfStreamError()
 
-            message_parsers[id](self, stream, n, length)
-        except KeyError as e:
-            self.logger.warning('[MESSAGE] UNKNOWN MESSAGE ID: {}'.format(id))
+        dispatch = self._DISPATCH
+        handler = dispatch[id] if id < len(dispatch) else None
+        if handler is None:
+            self.logger.warning('[MESSAGE] UNKNOWN MESSAGE ID: %s', id)
             self.__new_message('unknown', message_id=id)
+        else:
+            handler(self, stream, n, length)
 
         return n + length + 4
 
+    # a malformed extension payload only affects its own message; the
+    # framing is still intact, so these parsers warn and skip the
+    # message instead of giving up on the stream.
+
     @register_extended_message('ut_metadata')
     def parse_message_ut_metadata(self, stream, n, length):
+        # data messages carry the metadata piece right after the
+        # bencoded dictionary.
         try:
-            ut_metadata = bencode.bdecode(stream[n+6:n+length+4])
-        except bencode.BTL.BTFailure:
-            raise InvalidBitTorrentStreamError()
-        if ut_metadata['msg_type'] == 0:
+            ut_metadata, header_size = _bdecode_dict(
+                _as_bytes(stream[n+6:n+length+4]), trailing_data=True)
+            msg_type = ut_metadata['msg_type']
+            piece = ut_metadata['piece']
+        except (BTFailure, KeyError):
+            self.__malformed_extended_message('ut_metadata')
+            return
+        if not isinstance(msg_type, (int, long)) or \
+           not isinstance(piece, (int, long)):
+            self.__malformed_extended_message('ut_metadata')
+            return
+        if msg_type == 0:
             self.logger.info(
-                '[MESSAGE] [EXTENDED] ut_metadata: request for piece {}'.format(
-                    ut_metadata['piece']))
-        elif ut_metadata['msg_type'] == 1:
-            size = length - 2 - bencode.bencode(ut_metadata)
+                '[MESSAGE] [EXTENDED] ut_metadata: request for piece %s',
+                piece)
+        elif msg_type == 1:
+            size = length - 2 - header_size
             self.logger.info(
-                '[MESSAGE] [EXTENDED] ut_metadata: piece {} of size {}'.format(
-                    ut_metadata['piece'], size))
-        elif ut_metadata['msg_type'] == 2:
+                '[MESSAGE] [EXTENDED] ut_metadata: piece %s of size %s',
+                piece, size)
+        elif msg_type == 2:
             self.logger.info(
-                '[MESSAGE] [EXTENDED] ut_metadata: reject request for piece {}'.format(
-                    ut_metadata['piece']))
-        self.__new_extended_message('ut_metadata', piece=ut_metadata['piece'])
+                '[MESSAGE] [EXTENDED] ut_metadata: reject request for piece %s',
+                piece)
+        self.__new_extended_message('ut_metadata', piece=piece)
 
     @register_extended_message('upload_only')
     def parse_message_upload_only(self, stream, n, length):
         payload = stream[n+6:n+length+4]
-        self.logger.info('[MESSAGE] [EXTENDED] upload_only: turned {}'.format(
-            'off' if payload[0] == '\x00' else 'on'))
+        if len(payload) < 1:
+            self.__malformed_extended_message('upload_only')
+            return
+        self.logger.info('[MESSAGE] [EXTENDED] upload_only: turned %s',
+                         'off' if payload[0] == '\x00' else 'on')
         self.__new_extended_message('upload_only', value=(payload[0] != '\x00'))
 
     @register_extended_message('lt_tex')
     def parse_message_lt_tex(self, stream, n, length):
         try:
-            lt_tex = bencode.bdecode(stream[n+6:n+length+4])
-        except bencode.BTL.BTFailure:
-            raise InvalidBitTorrentStreamError()
-        self.logger.info('[MESSAGE] [EXTENDED] lt_tex: announced {} tracker(s).'.format(
-            len(lt_tex['added'])))
-        self.__new_extended_message('lt_tex', added=lt_tex['added'])
+            lt_tex, _ = _bdecode_dict(_as_bytes(stream[n+6:n+length+4]))
+            added = lt_tex['added']
+        except (BTFailure, KeyError):
+            self.__malformed_extended_message('lt_tex')
+            return
+        if not isinstance(added, list):
+            self.__malformed_extended_message('lt_tex')
+            return
+        self.logger.info('[MESSAGE] [EXTENDED] lt_tex: announced %s tracker(s).',
+                         len(added))
+        self.__new_extended_message('lt_tex', added=added)
 
     @register_extended_message('ut_pex')
     def parse_message_ut_pex(self, stream, n, length):
         try:
-            ut_pex = bencode.bdecode(stream[n+6:n+length+4])
-        except bencode.BTL.BTFailure:
-            raise InvalidBitTorrentStreamError()
-        added = ut_pex['added']
-        prefer_encryption = len([i for i in ut_pex['added.f'] if ord(i) & 0x01 == 1])
-        seeders = len([i for i in ut_pex['added.f'] if ord(i) & 0x02 == 1])
+            ut_pex, _ = _bdecode_dict(_as_bytes(stream[n+6:n+length+4]))
+            added = ut_pex['added']
+            added_f = ut_pex['added.f']
+            dropped = ut_pex['dropped']
+        except (BTFailure, KeyError):
+            self.__malformed_extended_message('ut_pex')
+            return
+        fields = [added, added_f, dropped]
+
+        # the IPv6 fields are only looked at if all of them are present.
+        ipv6 = all(k in ut_pex for k in ['added6', 'added6.f', 'dropped6'])
+        if ipv6:
+            added6 = ut_pex['added6']
+            added6_f = ut_pex['added6.f']
+            dropped6 = ut_pex['dropped6']
+            fields += [added6, added6_f, dropped6]
+
+        if not all(isinstance(f, str) for f in fields):
+            self.__malformed_extended_message('ut_pex')
+            return
+
+        prefer_encryption, seeders = _count_pex_flags(added_f)
         self.logger.info(
-            '[MESSAGE] [EXTENDED] ut_pex: added {} peers ({} prefer(s) '
-            'encryption; {} is/are seeder(s)). dropped {}.'.format(
-                len(added) / 6, # In compact form, each 6 bytes
-                                # represents an IPv4 address and a
-                                # port number.
+            '[MESSAGE] [EXTENDED] ut_pex: added %s peers (%s prefer(s) '
+            'encryption; %s is/are seeder(s)). dropped %s.',
+            len(added) / 6, # In compact form, each 6 bytes
+                            # represents an IPv4 address and a
+                            # port number.
+            prefer_encryption,
+            seeders,
+            len(dropped) / 6)
+
+        if ipv6 and (len(added6) > 0 or len(dropped6) > 0):
+            prefer_encryption, seeders = _count_pex_flags(added6_f)
+            self.logger.info(
+                '[MESSAGE] [EXTENDED]         also added %s IPv6 peers '
+                '(%s prefer(s) encryption; %s is/are seeder(s)). '
+                'dropped %s.',
+                len(added6) / 18, # In compact form, each 18 bytes
+                                  # represents an IPv6 address and
+                                  # a port number.
                 prefer_encryption,
                 seeders,
-                len(ut_pex['dropped']) / 6))
-
-        if all(k in ut_pex for k in ['added6', 'added6.f', 'dropped6']) and \
-           (len(ut_pex['added6']) > 0 or len(ut_pex['dropped6']) > 0):
-            added = ut_pex['added6']
-            prefer_encryption = len([i for i in ut_pex['added6.f'] if ord(i) & 0x01 == 1])
-            seeders = len([i for i in ut_pex['added6.f'] if ord(i) & 0x02 == 1])
-            self.logger.info(
-                '[MESSAGE] [EXTENDED]         also added {} IPv6 peers '
-                '({} prefer(s) encryption; {} is/are seeder(s)). '
-                'dropped {}.'.format(
-                    len(added) / 18, # In compact form, each 18 bytes
-                                     # represents an IPv6 address and
-                                     # a port number.
-                    prefer_encryption,
-                    seeders,
-                    len(ut_pex['dropped6']) / 18))
+                len(dropped6) / 18)
 
         self.__new_extended_message('ut_pex', value=ut_pex)
 
@@ -186,11 +321,25 @@ class BitTorrentParser(object):
         id = ord(stream[n])
         n += 1
         if id == 0:
-            handshake = stream[n:n + (length - 2)]
-            handshake = bencode.bdecode(handshake)
-            self.logger.info('[MESSAGE] [EXTENDED] HANDSHAKE: {}'.format(handshake))
+            # _bdecode_dict only returns dictionaries, so this also covers
+            # handshakes that decode to some other value.
+            try:
+                handshake, _ = _bdecode_dict(_as_bytes(stream[n:n + (length - 2)]))
+            except BTFailure:
+                self.__malformed_extended_message('handshake')
+                return
+
+            # every key in the handshake is optional (BEP 10), including
+            # the dictionary of supported extensions.
+            m = handshake.get('m', {})
+            if not isinstance(m, dict) or \
+               not all(isinstance(i, (int, long)) for i in m.values()):
+                self.__malformed_extended_message('handshake')
+                return
+
+            self.logger.info('[MESSAGE] [EXTENDED] HANDSHAKE: %s', handshake)
 
-            for name, number in handshake['m'].items():
+            for name, number in m.items():
                 if number == 0:
                     # disable this extension
                     extended_message_associations = {
@@ -202,13 +351,13 @@ class BitTorrentParser(object):
         elif id in extended_message_associtions:
             name = extended_message_associtions[id]
             if name not in extended_message_parsers:
-                self.logger.info('[MESSAGE][EXTENDED] "{}" message.'.format(name))
+                self.logger.info('[MESSAGE][EXTENDED] "%s" message.', name)
                 self.new_extended_message(name)
                 return
             extended_message_parsers[name](self, stream, n - 6, length)
         else:
             self.logger.warning(
-                '[MESSAGE] [EXTENDED] UNKNOWN MESSAGE ID: {}'.format(id))
+                '[MESSAGE] [EXTENDED] UNKNOWN MESSAGE ID: %s', id)
             # this is not a valid message (the id used has not been
             # defined in the handshake), so we won't call
             # self.__new_extended_message.
@@ -235,59 +384,59 @@ class BitTorrentParser(object):
 
     @register_message(4)
     def parse_message_have(self, stream, n, length):
-        index = ntohl(struct.unpack('I', stream[n+5:n+9])[0])
-        self.logger.info('[MESSAGE] HAVE: {}'.format(index))
-        self.__new_message('have', index=index)
+        (index,) = _U32.unpack_from(stream, n+5)
+        self.logger.info('[MESSAGE] HAVE: %s', index)
+        self.new_have(index)
 
     @register_message(5)
     def parse_message_bitfield(self, stream, n, length):
-        bitfield = stream[n+5:n+length]
-        bitfield_str = ''.join(bin(ord(i))[2:] for i in stream[n+5:n+length])
-        self.logger.info('[MESSAGE] BITFIELD: {}'.format(bitfield_str))
+        bitfield = _as_bytes(stream[n+5:n+4+length])
+        if self.logger.isEnabledFor(logging.INFO):
+            if bitfield:
+                bitfield_str = '{:0{}b}'.format(
+                    int(hexlify(bitfield), 16), 8 * len(bitfield))
+            else:
+                bitfield_str = ''
+            self.logger.info('[MESSAGE] BITFIELD: %s', bitfield_str)
         self.__new_message('bitfield', bitfield=bitfield)
 
     @register_message(6)
     def parse_message_request(self, stream, n, length):
-        index = ntohl(struct.unpack('I', stream[n+5:n+9])[0])
-        begin = ntohl(struct.unpack('I', stream[n+9:n+13])[0])
-        length = ntohl(struct.unpack('I', stream[n+13:n+17])[0])
+        index, begin, length = _TRIPLE.unpack_from(stream, n+5)
         self.logger.info(
-            '[MESSAGE] REQUEST: index={} begin={} length={}'.format(
-                index, begin, length))
-        self.__new_message('request', index=index, begin=begin, length=length)
+            '[MESSAGE] REQUEST: index=%s begin=%s length=%s',
+            index, begin, length)
+        self.new_request(index, begin, length)
 
     @register_message(7)
     def parse_message_piece(self, stream, n, length):
-        index = ntohl(struct.unpack('I', stream[n+5:n+9])[0])
-        begin = ntohl(struct.unpack('I', stream[n+9:n+13])[0])
+        index, begin = _PAIR.unpack_from(stream, n+5)
         block_size = length - 1 - 8
-        data = stream[n+13:n+13+length-1-8]
+        data = _as_bytes(stream[n+13:n+13+length-1-8])
         assert(len(data) == block_size)
         self.logger.info(
-            '[MESSAGE] PIECE: index={} begin={} length={}'.format(
-                index, begin, block_size))
-        self.__new_message('piece', index=index, begin=begin, data=data)
+            '[MESSAGE] PIECE: index=%s begin=%s length=%s',
+            index, begin, block_size)
+        self.new_piece(index, begin, data)
 
     @register_message(8)
     def parse_message_choke(self, stream, n, length):
-        index = ntohl(struct.unpack('I', stream[n+5:n+9])[0])
-        begin = ntohl(struct.unpack('I', stream[n+9:n+13])[0])
-        length = ntohl(struct.unpack('I', stream[n+13:n+17])[0])
+        index, begin, length = _TRIPLE.unpack_from(stream, n+5)
         self.logger.info(
-            '[MESSAGE] CANCEL: index={} begin={} length={}'.format(
-                index, begin, length))
+            '[MESSAGE] CANCEL: index=%s begin=%s length=%s',
+            index, begin, length)
         self.__new_message('cancel', index=index, begin=begin, length=length)
 
     @register_message(9)
     def parse_message_port(self, stream, n, length):
-        port = ntohs(struct.unpack('H', stream[n+5:n+7])[0])
-        self.logger.info('[MESSAGE] PORT: {}'.format(port))
+        (port,) = _U16.unpack_from(stream, n+5)
+        self.logger.info('[MESSAGE] PORT: %s', port)
         self.__new_message('port', port=port)
 
     @register_message(0x0d)
     def parse_message_suggest_piece(self, stream, n, length):
-        index = ntohl(struct.unpack('I', stream[n+5:n+9])[0])
-        self.logger.info('[MESSAGE] SUGGEST PIECE: {}'.format(index))
+        (index,) = _U32.unpack_from(stream, n+5)
+        self.logger.info('[MESSAGE] SUGGEST PIECE: %s', index)
         self.__new_message('suggest_piece', index=index)
 
     @register_message(0x0e)
@@ -302,20 +451,22 @@ class BitTorrentParser(object):
 
     @register_message(0x10)
     def parse_message_reject(self, stream, n, length):
-        index = ntohl(struct.unpack('I', stream[n+5:n+9])[0])
-        begin = ntohl(struct.unpack('I', stream[n+9:n+13])[0])
-        length = ntohl(struct.unpack('I', stream[n+13:n+17])[0])
+        index, begin, length = _TRIPLE.unpack_from(stream, n+5)
         self.logger.info(
-            '[MESSAGE] REJECT: index={} begin={} length={}'.format(
-                index, begin, length))
+            '[MESSAGE] REJECT: index=%s begin=%s length=%s',
+            index, begin, length)
         self.__new_message('reject')
 
     @register_message(0x11)
     def parse_message_allowed_fast(self, stream, n, length):
-        index = ntohl(struct.unpack('I', stream[n+5:n+9])[0])
-        self.logger.info('[MESSAGE] ALLOWED FAST: {}'.format(index))
+        (index,) = _U32.unpack_from(stream, n+5)
+        self.logger.info('[MESSAGE] ALLOWED FAST: %s', index)
         self.__new_message('allowed_fast')
 
+    def __malformed_extended_message(self, name):
+        self.logger.warning(
+            '[MESSAGE] [EXTENDED] MALFORMED %s MESSAGE.', name)
+
     def __new_extended_message(self, name, **attrs):
         self.__new_message(20, extension_name=name, **attrs)
         self.new_extended_message(name, **attrs)
@@ -329,78 +480,125 @@ class BitTorrentParser(object):
     def new_extended_message(self, name, **attrs):
         pass
 
+    # have, request and piece are by far the most common messages, so
+    # they get their own callbacks with positional arguments. they can
+    # be overridden to skip building the keyword arguments of
+    # new_message; by default they just forward to it.
+
+    def new_have(self, index):
+        self.new_message('have', index=index)
+
+    def new_request(self, index, begin, length):
+        self.new_message('request', index=index, begin=begin, length=length)
+
+    def new_piece(self, index, begin, data):
+        self.new_message('piece', index=index, begin=begin, data=data)
+
+# message ids are small integers, so once all the parsers above are
+# registered, freeze them into a tuple indexed by id and dispatch
+# through that instead of the message_parsers dict.
+BitTorrentParser._DISPATCH = tuple(
+    message_parsers.get(i) for i in range(max(message_parsers) + 1))
+
+def _new_piece():
+    # the state of a piece being downloaded. blocks are hashed as soon
+    # as all the data before them has been hashed; blocks arriving out
+    # of order wait in 'pending', keyed by their 'begin' offset.
+    return {'hash': hashlib.sha1(), 'next_begin': 0, 'pending': {}}
+
 class MyBitTorrentParser(BitTorrentParser):
     def __init__(self):
         super(MyBitTorrentParser, self).__init__()
-        self.pieces = defaultdict(list)
+        # maps infohash to a dict mapping piece indices to the state of
+        # the piece.
+        self.pieces = defaultdict(lambda: defaultdict(_new_piece))
         self.current_pieces_size = 0
 
-    def new_message(self, name, **attrs):
-        if name != 'piece':
-            return
+    # only pieces are of interest here; the other common messages are
+    # dropped without going through new_message.
+
+    def new_have(self, index):
+        pass
 
-        index = attrs['index']
-        begin = attrs['begin']
-        data = attrs['data']
+    def new_request(self, index, begin, length):
+        pass
 
+    def new_piece(self, index, begin, data):
         self.current_pieces_size += len(data)
-        self.pieces[(self.current_infohash, index)].append((data, begin))
-        self.check_piece(index)
 
-    def check_piece(self, index):
-        if self.current_infohash not in self.infos:
+        # there's nothing to check the piece against if the torrent has
+        # not been added.
+        if self.current_info is None:
             return
 
-        info = self.infos[self.current_infohash]
-        piece_length = info['piece length']
-
-        blocks = self.pieces[(self.current_infohash, index)]
-        blocks.sort(key=lambda r: r[1])
-
-        piece = ''
-        n = 0
-        while n < piece_length:
-            b = [i[0] for i in blocks if i[1] == n]
-            if b == []:
-                break
+        self.check_piece(index, begin, data)
 
-            b = b[0]
-            piece += b
-
-            blocks = [i for i in blocks if i[1] != n]
-
-            n += len(b)
+    def check_piece(self, index, begin, data):
+        info = self.current_info
+        piece_length = info['piece length']
 
-        if len(piece) == piece_length:
-            self.logger.info('Piece complete: {}'.format(index))
-            got_hash = hashlib.sha1(piece).digest()
+        pieces = self.pieces[self.current_infohash]
+        piece = pieces[index]
+        pending = piece['pending']
+
+        if begin == piece['next_begin']:
+            h = piece['hash']
+            n = begin
+            while data:
+                h.update(data)
+                n += len(data)
+                data = pending.pop(n, None)
+            piece['next_begin'] = n
+        elif begin > piece['next_begin']:
+            pending[begin] = data
+
+        if piece['next_begin'] == piece_length:
+            self.logger.info('Piece complete: %s', index)
+            got_hash = piece['hash'].digest()
             expected_hash = info['pieces'][index*20:index*20+20]
 
             if got_hash == expected_hash:
-                self.logger.info('Hash match for piece: {}'.format(index))
+                self.logger.info('Hash match for piece: %s', index)
             else:
-                self.logger.warning('Hash did not match for piece: {}'.format(index))
+                self.logger.warning('Hash did not match for piece: %s', index)
 
-            del self.pieces[(self.current_infohash, index)]
+            del pieces[index]
 
 def parse_file(filename, parser):
-    parser.logger.info('[NEW FILE] {}'.format(filename))
-    with open(filename) as f:
-        stream = f.read()
+    parser.logger.info('[NEW FILE] %s', filename)
 
+    # map regular files instead of reading them, so that the data is
+    # paged in as it is parsed and only the parts the parsers keep get
+    # copied. empty files can't be mapped, and pipes and other special
+    # files report no meaningful size, so those are read instead.
+    fd = os.open(filename, os.O_RDONLY)
     try:
-        parser.current_pieces_size = 0
-        parser.parse_stream(stream)
-    except BitTorrentParserError as e:
-        parser.logger.error(str(e))
+        st = os.fstat(fd)
+        mapped = stat.S_ISREG(st.st_mode) and st.st_size > 0
+        if mapped:
+            stream = mmap.mmap(fd, st.st_size, access=mmap.ACCESS_READ)
+        else:
+            with os.fdopen(os.dup(fd), 'rb') as f:
+                stream = f.read()
+    finally:
+        os.close(fd)
+
+    try:
+        try:
+            parser.current_pieces_size = 0
+            parser.parse_stream(stream)
+        except BitTorrentParserError as e:
+            parser.logger.error(str(e))
 
-    parser.logger.info(
-        '{} bytes of piece data in a stream of {} bytes.'.format(
+        parser.logger.info(
+            '%s bytes of piece data in a stream of %s bytes.',
             parser.current_pieces_size,
-            len(stream)))
+            len(stream))
+    finally:
+        if mapped:
+            stream.close()
 
 def parse_directory(directory, parser):
-    import os
     for filename in os.listdir(directory):
         parse_file(directory + '/' + filename, parser)
 
@@ -438,7 +636,7 @@ def main():
         handler = logging.FileHandler(args.log_file, 'w')
     else:
         handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter('[%(levelname)s]\t%(msg)s')
+    formatter = logging.Formatter('[%(levelname)s]\t%(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
     logger.setLevel(logging.DEBUG)
@@ -447,7 +645,7 @@ def main():
     if args.torrent:
         for tf in args.torrent:
             with open(tf) as f:
-                btparser.add_info(bencode.bdecode(f.read())['info'])
+                btparser.add_info(bdecode(f.read())['info'])
     else:
         logger.warning('No torrent files specified.')
 